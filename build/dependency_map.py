@@ -1,11 +1,6 @@
 #!/usr/bin/python
 # Copyright (c) 2020 Advanced Micro Devices, Inc. All rights reserved.
 
-import sys
-
-# prevent generation of .pyc file
-sys.dont_write_bytecode = True
-
 ####### Git Dependencies #######
 
 # To allow for future updates where we may have cloned the project somewhere other than gerrit, store the root of
@@ -13,7 +8,10 @@ sys.dont_write_bytecode = True
 gitRoot = "https://github.com/GPUOpen-Tools/"
 
 # Define a set of dependencies that exist as separate git projects.
-# each git dependency has a desired directory where it will be cloned - along with a commit to checkout
+# each git dependency has a desired directory where it will be cloned - along with a commit to checkout.
+# This is the single dependency table used by fetch_dependencies.py. The commit may be a tag, a branch or a full
+# commit SHA. An entry may optionally have a third boolean element specifying that the repo's submodules should also
+# be fetched (defaults to False when omitted).
 gitMapping = {
     gitRoot + "QtCommon"                : ["../external/qt_common",        "v3.6.0"],
     gitRoot + "UpdateCheckAPI"          : ["../external/update_check_api", "v2.0.0"],
@@ -11,19 +11,17 @@
 # Each git repo will be updated to the commit specified in the "gitMapping" table.
 
 import os
+import re
+import json
+import hashlib
+import shutil
+import time
 import subprocess
 import sys
-import zipfile
-import tarfile
-import platform
 import argparse
-
-# Check for the python 3.x name and import it as the 2.x name
-try:
-    import urllib.request as urllib
-# if that failed, then try the 2.x name
-except ImportError:
-    import urllib
+import threading
+import functools
+import concurrent.futures
 
 # to allow the script to be run from anywhere - not just the cwd - store the absolute path to the script file
 scriptRoot = os.path.dirname(os.path.realpath(__file__))
@@ -31,77 +29,311 @@ scriptRoot = os.path.dirname(os.path.realpath(__file__))
 # also store the basename of the file
 scriptName = os.path.basename(__file__)
 
+# Serializes console output from the worker threads that update the git dependencies in parallel
+printLock = threading.Lock()
+
 # Print a message to the console with appropriate pre-amble
 def logPrint(message):
-    print ("\n" + scriptName + ": " + message)
-    sys.stdout.flush()
+    with printLock:
+        print(f"\n{scriptName}: {message}")
+        sys.stdout.flush()
+
+# Run a git command. Its progress output is discarded, any error output is buffered and printed as a single block
+# only if the command fails and printErrors is set. If a repo path is given, git is pointed at it with -C rather than
+# changing the working directory of the process
+def runGitCommand(gitArgs, path=None, printErrors=True):
+    if path is not None:
+        gitArgs = ["-C", path] + gitArgs
+    p = subprocess.Popen(["git"] + gitArgs, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    output = p.communicate()[1]
+    if p.returncode != 0 and output and printErrors:
+        with printLock:
+            sys.stdout.write(output.decode(errors="replace"))
+            sys.stdout.flush()
+    return p.returncode
 
 # add script root to support import of URL and git maps
 sys.path.append(scriptRoot)
 from dependency_map import gitMapping
 
-# Clone or update a git repo
-def updateGitDependencies(gitMapping, update):
-    for gitRepo in gitMapping:
-        # add script directory to path
-        tmppath = os.path.join(scriptRoot, gitMapping[gitRepo][0])
-
-        # clean up path, collapsing any ../ and converting / to \ for Windows
-        path = os.path.normpath(tmppath)
-
-        # required commit
-        reqdCommit = gitMapping[gitRepo][1]
-
-        doCheckout = False
-        if not os.path.isdir(path):
-            # directory doesn't exist - clone from git
-            logPrint("Directory %s does not exist, using 'git clone' to get latest from %s" % (path, gitRepo))
-            p = subprocess.Popen((["git", "clone", gitRepo ,path]), stderr=subprocess.STDOUT)
-            p.wait()
-            if(p.returncode == 0):
-                doCheckout = True
-            else:
-                logPrint("git clone failed with return code: %d" % p.returncode)
-                return False
-        elif update == True:
-            # directory exists and update requested - get latest from git
-            logPrint("Directory %s exists, using 'git fetch --tags' to get latest from %s" % (path, gitRepo))
-            p = subprocess.Popen((["git", "fetch", "--tags"]), cwd=path, stderr=subprocess.STDOUT)
-            p.wait()
-            if(p.returncode == 0):
-                doCheckout = True
-            else:
-                logPrint("git fetch failed with return code: %d" % p.returncode)
-                return False
+# Convert a dependency table into the form used by updateGitDependencies: each entry's directory is added to the script
+# directory and cleaned up (collapsing any ../ and converting / to \ for Windows), and the optional submodules flag is
+# filled in
+def normalizeGitMapping(gitMapping):
+    normalizedMapping = {}
+    for gitRepo, entry in gitMapping.items():
+        path = os.path.normpath(os.path.join(scriptRoot, entry[0]))
+        submodules = len(entry) > 2 and entry[2]
+        normalizedMapping[gitRepo] = (path, entry[1], submodules)
+    return normalizedMapping
+
+# The dependency table is constant, so normalize it once when the script is loaded
+normalizedGitMapping = normalizeGitMapping(gitMapping)
+
+# Root directory of the optional local cache of dependency repos. New clones borrow objects from the cache, so only
+# objects that are new since the cache was last refreshed need to be downloaded. The cache holds a full mirror of each
+# repo, so it is only created when RMV_DEPENDENCY_CACHE=1 is set in the environment. Existing cached copies are always
+# used
+referenceCacheRoot = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "rmv-deps")
+createReferenceCache = os.environ.get("RMV_DEPENDENCY_CACHE") == "1"
+
+# Create or refresh the cached mirror of a git repo, returning its path, or None if the repo isn't cached. Failing to
+# update the cache isn't fatal, the clone just has to download everything itself
+def updateReferenceCache(gitRepo):
+    cacheDir = os.path.join(referenceCacheRoot, hashlib.sha1(gitRepo.encode()).hexdigest())
+    if os.path.isdir(cacheDir):
+        logPrint(f"Refreshing cached copy of {gitRepo} in {cacheDir}")
+        returnCode = runGitCommand(["fetch", "--quiet", "--prune"], cacheDir)
+    elif createReferenceCache:
+        logPrint(f"Creating cached copy of {gitRepo} in {cacheDir}")
+        returnCode = runGitCommand(["clone", "--quiet", "--mirror", gitRepo, cacheDir])
+    else:
+        return None
+    if(returnCode != 0):
+        logPrint(f"Unable to update cached copy of {gitRepo}, git returned: {returnCode}")
+    return cacheDir
+
+# Check whether a required commit is a full commit SHA, as opposed to a tag
+def isCommitSha(reqdCommit):
+    return re.fullmatch("[0-9a-f]{40}", reqdCommit) is not None
+
+# Name of the file, stored in the .git directory of each dependency, that caches the commit SHAs that tags resolve to
+dependencyCacheFileName = ".rmv_dep_cache.json"
+
+# Check whether a git repo already has the required commit checked out. HEAD and, for a tag, the commit the tag points
+# to are resolved with a single git process
+def isAtRequiredCommit(path, reqdCommit):
+    revisions = ["HEAD"]
+    if not isCommitSha(reqdCommit):
+        revisions.append(f"refs/tags/{reqdCommit}^{{commit}}")
+
+    # rev-parse fails if any revision is unknown, but still prints the commits of those it could resolve
+    p = subprocess.Popen(["git", "-C", path, "rev-parse"] + revisions, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    resolved = [line.strip() for line in p.communicate()[0].decode().splitlines()]
+    if len(resolved) == 0 or not isCommitSha(resolved[0]):
+        return False
+
+    headCommit = resolved[0]
+    if isCommitSha(reqdCommit):
+        return headCommit == reqdCommit
+    if len(resolved) > 1 and isCommitSha(resolved[1]):
+        return headCommit == resolved[1]
+    return headCommit == resolveRemoteTag(path, reqdCommit)
+
+# Resolve a tag that isn't known locally to a commit SHA, first from the cache file in the repo's .git directory and
+# then by querying the remote. Returns None if the tag can't be resolved
+def resolveRemoteTag(path, reqdCommit):
+    cacheFile = os.path.join(path, ".git", dependencyCacheFileName)
+    cache = {}
+    if os.path.isfile(cacheFile):
+        try:
+            with open(cacheFile) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+    if reqdCommit in cache:
+        return cache[reqdCommit]
+
+    # annotated tags are listed twice by ls-remote, the peeled "^{}" entry is the commit the tag points to
+    try:
+        output = subprocess.check_output(["git", "-C", path, "ls-remote", "origin", f"refs/tags/{reqdCommit}", f"refs/tags/{reqdCommit}^{{}}"], stderr=subprocess.DEVNULL).decode()
+    except subprocess.CalledProcessError:
+        return None
+    remoteRefs = dict(reversed(line.split()) for line in output.splitlines() if line.strip())
+    sha = remoteRefs.get(f"refs/tags/{reqdCommit}^{{}}", remoteRefs.get(f"refs/tags/{reqdCommit}"))
+    if sha is None:
+        return None
+
+    cache[reqdCommit] = sha
+    try:
+        with open(cacheFile, "w") as f:
+            json.dump(cache, f)
+    except OSError:
+        pass
+    return sha
+
+# Create a repo containing just the required commit, fetched directly by its SHA rather than cloning the history.
+# This needs the server to allow fetching unadvertised commits (GitHub does), so if any step fails the partially
+# created repo is removed and False is returned
+def fetchCommitBySha(gitRepo, path, reqdCommit):
+    logPrint(f"Directory {path} does not exist, using 'git fetch --depth=1' to get {reqdCommit} from {gitRepo}")
+    for gitArgs in (["init", "--quiet", path],
+                    ["-C", path, "remote", "add", "origin", gitRepo],
+                    ["-C", path, "fetch", "--quiet", "--depth=1", "origin", reqdCommit],
+                    ["-C", path, "-c", "advice.detachedHead=false", "checkout", "--quiet", "FETCH_HEAD"]):
+        if runGitCommand(gitArgs) != 0:
+            logPrint(f"Unable to fetch {reqdCommit} from {gitRepo} by SHA, falling back to git clone")
+            try:
+                shutil.rmtree(path)
+            except OSError as e:
+                logPrint(f"Unable to remove {path}: {e}")
+            return False
+    return True
+
+# Clone or update a single git repo
+def updateGitDependency(gitRepo, path, reqdCommit, submodules, update):
+    pinnedToSha = isCommitSha(reqdCommit)
+    doCheckout = False
+    doSubmoduleUpdate = False
+    # checked once, so a failed fetch by SHA always falls back to cloning, even if its directory couldn't be removed
+    directoryExists = os.path.isdir(path)
+    if not directoryExists and pinnedToSha and fetchCommitBySha(gitRepo, path, reqdCommit):
+        # directory didn't exist - the required commit has been fetched directly
+        doSubmoduleUpdate = submodules
+    elif not directoryExists:
+        # borrow any objects already in the local cache, --dissociate copies them so the clone doesn't depend on the cache
+        referenceCacheDir = updateReferenceCache(gitRepo)
+        referenceArgs = []
+        if referenceCacheDir is not None:
+            referenceArgs = ["--reference-if-able", referenceCacheDir, "--dissociate"]
+        if pinnedToSha:
+            # directory doesn't exist - do a treeless clone, only the blobs needed by the required commit are fetched at checkout
+            logPrint(f"Directory {path} does not exist, using 'git clone --filter=blob:none' to get latest from {gitRepo}")
+            returnCode = runGitCommand(["clone", "--quiet", "--filter=blob:none", "--no-checkout"] + referenceArgs + [gitRepo, path])
+        else:
+            # directory doesn't exist - do a shallow clone of the required tag, which also checks it out
+            logPrint(f"Directory {path} does not exist, using 'git clone --depth=1' to get {reqdCommit} from {gitRepo}")
+            returnCode = runGitCommand(["clone", "--quiet", "--depth=1", "--branch", reqdCommit, "--single-branch"] + referenceArgs + [gitRepo, path])
+        if(returnCode == 0):
+            doCheckout = pinnedToSha
+            doSubmoduleUpdate = submodules
+        else:
+            logPrint(f"git clone failed with return code: {returnCode}")
+            return False
+    elif update == True and isAtRequiredCommit(path, reqdCommit):
+        # directory exists and is already at the required commit
+        logPrint(f"Git Dependency {gitRepo} already at required commit {reqdCommit}")
+    elif update == True:
+        # directory exists and update requested - fetch just the required commit and move the working tree to it
+        logPrint(f"Directory {path} exists, using 'git fetch --depth=1' to get {reqdCommit} from {gitRepo}")
+        fetchArgs = ["fetch", "--quiet", "--depth=1", "--no-tags", "origin"]
+        if pinnedToSha:
+            returnCode = runGitCommand(fetchArgs + [reqdCommit], path)
         else:
-            # Directory exists and update not requested
-            logPrint("Git Dependency %s found and not updated" % gitRepo)
-
-        if doCheckout == True:
-            logPrint("Checking out required commit: %s" % reqdCommit)
-            p = subprocess.Popen((["git", "checkout", reqdCommit]), cwd=path, stderr=subprocess.STDOUT)
-            p.wait()
-            if(p.returncode != 0):
-                logPrint("git checkout failed with return code: %d" % p.returncode)
-                return False
-            logPrint("Ensuring any branch is on the head using git pull --ff-only origin %s" % reqdCommit)
-            p = subprocess.Popen((["git", "pull", "--ff-only", "origin", reqdCommit]), cwd=path, stderr=subprocess.STDOUT)
-            p.wait()
-            if(p.returncode != 0):
-                logPrint("git merge failed with return code: %d" % p.returncode)
-                return False
+            # fetch a tag into the local tag so later runs can resolve it without the remote. If there is no such tag
+            # the required commit is a branch, which is fetched by name
+            returnCode = runGitCommand(fetchArgs + [f"+refs/tags/{reqdCommit}:refs/tags/{reqdCommit}"], path, printErrors=False)
+            if(returnCode != 0):
+                returnCode = runGitCommand(fetchArgs + [reqdCommit], path)
+        if(returnCode != 0):
+            logPrint(f"git fetch failed with return code: {returnCode}")
+            return False
+        logPrint(f"Resetting to required commit: {reqdCommit}")
+        returnCode = runGitCommand(["-c", "advice.detachedHead=false", "reset", "--quiet", "--hard", "FETCH_HEAD"], path)
+        if(returnCode != 0):
+            logPrint(f"git reset failed with return code: {returnCode}")
+            return False
+        doSubmoduleUpdate = submodules
+    else:
+        # Directory exists and update not requested
+        logPrint(f"Git Dependency {gitRepo} found and not updated")
+
+    if doCheckout == True:
+        logPrint(f"Checking out required commit: {reqdCommit}")
+        returnCode = runGitCommand(["checkout", "--quiet", reqdCommit], path)
+        if(returnCode != 0):
+            logPrint(f"git checkout failed with return code: {returnCode}")
+            return False
+
+    if doSubmoduleUpdate == True:
+        # fetch the submodules concurrently rather than one at a time
+        jobs = os.cpu_count() or 4
+        logPrint(f"Updating submodules using git submodule update --init --recursive --jobs={jobs}")
+        returnCode = runGitCommand(["-c", f"submodule.fetchJobs={jobs}", "submodule", "update", "--quiet", "--init", "--recursive", "--depth=1", f"--jobs={jobs}"], path)
+        if(returnCode != 0):
+            logPrint(f"git submodule update failed with return code: {returnCode}")
+            return False
 
     return True
 
+# Clone or update all git repos, given a mapping normalized by normalizeGitMapping. The repos are independent of each
+# other, so they are processed concurrently
+def updateGitDependencies(normalizedMapping, update):
+    dependencies = [(gitRepo,) + normalizedMapping[gitRepo] for gitRepo in normalizedMapping]
+
+    if len(dependencies) == 0:
+        return True
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(dependencies))) as executor:
+        results = list(executor.map(lambda dependency: updateGitDependency(*dependency, update), dependencies))
+
+    return all(results)
+
+# File recording the commit that each git dependency was left at by the last successful update
+dependencyStateFile = os.path.join(scriptRoot, ".dep_state.json")
+
+# Get the commit currently checked out in a git repo, or None if it can't be determined
+def getHeadCommit(path):
+    try:
+        return subprocess.check_output(["git", "-C", path, "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except subprocess.CalledProcessError:
+        return None
+
+# Get the kind of a dependency's required commit: "sha" or "tag", which always refer to the same commit, or "branch",
+# whose tip can move on the remote
+def getRefKind(path, reqdCommit):
+    if isCommitSha(reqdCommit):
+        return "sha"
+    if runGitCommand(["rev-parse", "--verify", "--quiet", f"refs/tags/{reqdCommit}^{{commit}}"], path, printErrors=False) == 0:
+        return "tag"
+    return "branch"
+
+# Check whether every git dependency is still at the commit recorded by the last successful update, and that the
+# required commits haven't changed since. A branch may have moved on the remote, so if any dependency is on a branch
+# the dependencies are never considered up to date. The HEAD of each repo is checked concurrently
+def dependenciesUpToDate(normalizedMapping):
+    try:
+        with open(dependencyStateFile) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    for gitRepo, (path, reqdCommit, submodules) in normalizedMapping.items():
+        entry = state.get(gitRepo)
+        if not isinstance(entry, dict) or entry.get("ref") != reqdCommit or entry.get("path") != path or not os.path.isdir(path):
+            return False
+        if entry.get("kind") not in ["sha", "tag"]:
+            return False
+
+    paths = [path for path, reqdCommit, submodules in normalizedMapping.values()]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(8, len(paths)))) as executor:
+        headCommits = list(executor.map(getHeadCommit, paths))
+
+    return all(headCommit is not None and headCommit == state[gitRepo].get("sha") for gitRepo, headCommit in zip(normalizedMapping, headCommits))
+
+# Record the commit that each git dependency is at, so that later runs can skip updating them
+def writeDependencyState(normalizedMapping):
+    state = {}
+    for gitRepo, (path, reqdCommit, submodules) in normalizedMapping.items():
+        state[gitRepo] = {"ref": reqdCommit, "kind": getRefKind(path, reqdCommit), "sha": getHeadCommit(path), "path": path, "ts": int(time.time())}
+    try:
+        with open(dependencyStateFile, "w") as f:
+            json.dump(state, f, indent=4)
+    except OSError as e:
+        logPrint(f"Unable to write {dependencyStateFile}: {e}")
+
+# Get the version of git being used, only spawning git the first time it is queried
+@functools.lru_cache(maxsize=None)
+def getGitVersion():
+    return subprocess.check_output(["git", "--version"], stderr=subprocess.STDOUT).decode().strip()
+
 # Main body of update functionality
 def doFetchDependencies(update, internal):
-    # Print git version being used
-    gitCmd = ["git", "--version"]
-    gitOutput = subprocess.check_output(gitCmd, stderr=subprocess.STDOUT)
-    logPrint("%s" % gitOutput)
+    # Nothing needs to be updated if every dependency is still where the last successful update left it. Without an
+    # update the existing repos are left alone anyway, so the state doesn't need to be checked
+    if update and dependenciesUpToDate(normalizedGitMapping):
+        logPrint("Git dependencies are up to date")
+        return True
+
+    # Print git version being used. Spawning processes is slow on Windows, so only do it there when updating
+    if update or sys.platform != "win32":
+        logPrint(getGitVersion())
 
     # Update all git dependencies
-    if updateGitDependencies(gitMapping, update):
+    if updateGitDependencies(normalizedGitMapping, update):
+        # only an update guarantees that every dependency is at its required commit
+        if update:
+            writeDependencyState(normalizedGitMapping)
         return True
     else:
         return False
@@ -11,10 +11,13 @@ import os
 import sys
 import argparse
 import shutil
+import glob
 import subprocess
-import distutils.spawn
-import platform
+import selectors
+import threading
 import time
+from pathlib import Path
+import hashlib
 
 # Remember the start time
 startTime = time.time()
@@ -22,11 +25,6 @@ startTime = time.time()
 # Enable/Disable options supported by this project
 support32BitBuild = False
 
-# prevent fetch_dependency script from leaving a compiled .pyc file in the script directory
-sys.dont_write_bytecode = True
-
-import fetch_dependencies
-
 # to allow the script to be run from anywhere - not just the cwd - store the absolute path to the script file
 scriptRoot = os.path.dirname(os.path.realpath(__file__))
 
@@ -60,11 +58,14 @@ parser.add_argument("--disable-break", action="store_true", help="disable RGP_DE
 parser.add_argument("--update", action="store_true", help="Force fetch_dependencies script to update all dependencies")
 parser.add_argument("--output", default=outputRoot, help="specify the output location for generated cmake and build output files (default = OS specific subdirectory of location of PreBuild.py script)")
 parser.add_argument("--build", action="store_true", help="build all supported configurations on completion of prebuild step")
-parser.add_argument("--build-jobs", default="4", help="number of simultaneous jobs to run during a build (default = 4)")
+parser.add_argument("--build-jobs", default=os.cpu_count() or 4, type=int, help="number of simultaneous jobs to run during a build (default = number of CPUs)")
 if support32BitBuild:
     parser.add_argument("--platform", default="x64", choices=["x64", "x86"], help="specify the platform (32 or 64 bit)")
 args = parser.parse_args()
 
+if args.build_jobs < 1:
+    parser.error("--build-jobs must be at least 1")
+
 # Define the build configurations that will be generated
 configs = ["debug", "release"]
 
@@ -85,22 +86,108 @@ def logErrorAndExit(message):
     sys.stdout.flush()
     sys.exit(-1)
 
-# Remove a directory and all subdirectories - printing relevant status
+# Remove a directory and all subdirectories. On Linux & Mac this is handed to 'rm -rf' to avoid the per-file overhead of
+# doing it from Python. Elsewhere shutil.rmtree is used, as it removes directory junctions without following them
+def removeTree(dir):
+    if sys.platform != "win32" and shutil.which("rm"):
+        if subprocess.call(["rm", "-rf", dir]) != 0:
+            raise OSError("rm -rf failed")
+        return
+
+    shutil.rmtree(dir)
+
+# Directories being deleted in the background by rmdirPrint, along with any errors from deleting them
+pendingRemovals = []
+removalErrors = []
+
+# Remove a directory and all subdirectories - printing relevant status. The directory is first moved out of the way
+# with a single rename, so its name is free again immediately, and then deleted in the background. This allows the
+# directories being removed to be deleted concurrently; waitForRemovals must be called before exiting
 def rmdirPrint(dir):
     logPrint ("Removing directory - " + dir)
     if os.path.exists(dir):
+        removedDir = dir + ".del-" + os.urandom(4).hex()
         try:
-            shutil.rmtree(dir)
+            os.rename(dir, removedDir)
         except Exception as e:
             logErrorAndExit ("Failed to delete directory - " + dir + ": " + str(e))
+
+        def removeInBackground():
+            try:
+                removeTree(removedDir)
+            except Exception as e:
+                removalErrors.append("Failed to delete directory - " + dir + ": " + str(e))
+
+        thread = threading.Thread(target=removeInBackground)
+        thread.start()
+        pendingRemovals.append(thread)
     else:
         logPrint ("    " + dir + " doesn't exist!")
 
-# Make a directory if it doesn't exist - print information
+# Wait for all background directory deletions to complete
+def waitForRemovals():
+    for thread in pendingRemovals:
+        thread.join()
+    if removalErrors:
+        logErrorAndExit ("\n".join(removalErrors))
+
+# Make a directory if it doesn't exist - print information. The directory is created without checking whether it
+# exists first, which avoids an extra stat call and can't race with something else creating it
 def mkdirPrint(dir):
-    if not os.path.exists(dir):
-        logPrint ("Creating Directory: " + dir)
+    try:
         os.makedirs(dir)
+        logPrint ("Creating Directory: " + dir)
+    except FileExistsError:
+        if not os.path.isdir(dir):
+            logErrorAndExit ("Failed to create directory - " + dir + ": a file with that name already exists")
+    except OSError as e:
+        logErrorAndExit ("Failed to create directory - " + dir + ": " + str(e))
+
+# Run a command to completion with its output going straight to the console, returning its exit code. stdin is
+# closed so that a tool probing for input can't stall the script when run under CI
+def runCommand(cmd, cwd=None, env=None):
+    sys.stdout.flush()
+    returnCode = subprocess.run(cmd, cwd=cwd, env=env, stdin=subprocess.DEVNULL, stderr=subprocess.STDOUT).returncode
+    sys.stdout.flush()
+    return returnCode
+
+# Write the captured output of a child process to the console in one block
+def printProcessOutput(output):
+    sys.stdout.flush()
+    sys.stdout.buffer.write(output)
+    sys.stdout.flush()
+
+# Wait for processes started with stdout=subprocess.PIPE to complete, given as a dictionary mapping a description of
+# each process to the process. All of their output pipes are drained from a single selector, so no process can block on
+# a full pipe while another is being waited on, and each process's output is printed under its description as soon as
+# it finishes. Windows can't select on pipes, so there the processes are waited on in turn
+def reapProcesses(processes):
+    if sys.platform == "win32":
+        for description, p in processes.items():
+            output = p.communicate()[0]
+            logPrint("Output of " + description + ":")
+            printProcessOutput(output)
+        return
+
+    selector = selectors.DefaultSelector()
+    outputs = {}
+    for description, p in processes.items():
+        selector.register(p.stdout, selectors.EVENT_READ, (description, p))
+        outputs[p] = []
+
+    while selector.get_map():
+        for key, events in selector.select():
+            description, p = key.data
+            data = key.fileobj.read1(65536)
+            if data:
+                outputs[p].append(data)
+            else:
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+                p.wait()
+                logPrint("Output of " + description + ":")
+                printProcessOutput(b"".join(outputs[p]))
+    selector.close()
 
 # check that the default output directory exists
 mkdirPrint(args.output)
@@ -122,6 +209,10 @@ if sys.platform == "win32":
     if args.internal:
         cmakeOutputDir += internalSuffix
 
+# Define the directory used to cache the state of previous runs of this script
+prebuildCacheDir = os.path.join(args.output, ".prebuild_cache")
+dependencyDigestFile = os.path.join(prebuildCacheDir, "deps.sha256")
+
 # Clean all files generated by this script or the build process
 if (args.clean):
     logPrint ("Cleaning build ...\n")
@@ -133,12 +224,51 @@ if (args.clean):
             config += internalSuffix
         dir = os.path.join(args.output, config)
         rmdirPrint(dir)
+    # delete the cached state of previous runs
+    rmdirPrint(prebuildCacheDir)
+    waitForRemovals()
     sys.exit(0)
 
-# Call fetch_dependencies script
-logPrint ("Fetching project dependencies ...\n")
-if (fetch_dependencies.doFetchDependencies(args.update, args.internal) == False):
-    logErrorAndExit("Unable to retrieve dependencies")
+# Generate a digest of the files defining the project's dependencies, along with the options affecting which
+# dependencies are fetched
+def dependencyManifestDigest():
+    digest = hashlib.sha256()
+    for file in ["fetch_dependencies.py", "dependency_map.py"]:
+        with open(os.path.join(scriptRoot, file), "rb") as f:
+            digest.update(f.read())
+    digest.update(("internal=" + str(args.internal)).encode())
+    return digest.hexdigest()
+
+# fetch_dependencies is only imported here, so --help and --clean don't pay for loading it. If the script itself isn't
+# available, the dependencies are expected to already be in place. Any other import failure is still fatal
+try:
+    import fetch_dependencies
+    canFetch = True
+except ImportError as e:
+    if e.name != "fetch_dependencies":
+        raise
+    canFetch = False
+
+# Call fetch_dependencies script, unless the dependencies have already been fetched with the current manifest and
+# are all still present
+if not canFetch:
+    logPrint ("fetch_dependencies script not found, skipping fetching of project dependencies")
+else:
+    manifestDigest = dependencyManifestDigest()
+    cachedManifestDigest = None
+    if not args.update and os.path.isfile(dependencyDigestFile):
+        with open(dependencyDigestFile) as f:
+            cachedManifestDigest = f.read().strip()
+
+    if cachedManifestDigest == manifestDigest and all(os.path.isdir(path) for path, reqdCommit, submodules in fetch_dependencies.normalizedGitMapping.values()):
+        logPrint ("Dependencies up to date (cached)")
+    else:
+        logPrint ("Fetching project dependencies ...\n")
+        if (fetch_dependencies.doFetchDependencies(args.update, args.internal) == False):
+            logErrorAndExit("Unable to retrieve dependencies")
+        mkdirPrint(prebuildCacheDir)
+        with open(dependencyDigestFile, "w") as f:
+            f.write(manifestDigest)
 
 # Create the CMake output directory
 mkdirPrint(cmakeOutputDir)
@@ -167,33 +297,24 @@ else:
 # again. This allows the default Qt install path on Linux to be
 # found without needing to specify a qt-root
 
-qtExpandedRoot = os.path.expanduser(args.qt_root)
-
-qtPathNotFoundError = "Unable to find Qt root dir. Use --qt-root to specify\n    Locations checked:"
-
-qtPath = os.path.normpath(qtExpandedRoot + "/" + "Qt" + args.qt + "/" + args.qt)
-if not os.path.exists(qtPath):
-    qtPathNotFoundError = qtPathNotFoundError + "\n      " + qtPath
-    qtPath = os.path.normpath(qtExpandedRoot + "/" + args.qt)
-    if not os.path.exists(qtPath):
-        qtPathNotFoundError = qtPathNotFoundError + "\n      " + qtPath
-        # if there is no user-specified qt-root, then check additional locations
-        # used by the various Qt installers
-        if args.qt_root == parser.get_default('qt_root'):
-            qtPath = os.path.normpath(qtExpandedRoot + "/../" + "Qt" + args.qt + "/" + args.qt)
-            if not os.path.exists(qtPath):
-                qtPathNotFoundError = qtPathNotFoundError + "\n      " + qtPath
-                qtPath = os.path.normpath(qtExpandedRoot + "/../" + args.qt)
-                if not os.path.exists(qtPath):
-                    qtPathNotFoundError = qtPathNotFoundError + "\n      " + qtPath
-                    logErrorAndExit(qtPathNotFoundError)
-        else:
-            logErrorAndExit(qtPathNotFoundError)
+qtExpandedRoot = Path(args.qt_root).expanduser()
+
+qtCandidates = [qtExpandedRoot / ("Qt" + args.qt) / args.qt,
+                qtExpandedRoot / args.qt]
+
+# if there is no user-specified qt-root, then check additional locations
+# used by the various Qt installers
+if args.qt_root == parser.get_default('qt_root'):
+    qtCandidates.append(qtExpandedRoot.parent / ("Qt" + args.qt) / args.qt)
+    qtCandidates.append(qtExpandedRoot.parent / args.qt)
 
-qtPath = os.path.normpath(qtPath + "/"  + qtLeaf)
+# use the first location containing the platform specific Qt directory. A single is_dir call checks the whole path,
+# failing at the first component that doesn't exist
+qtPath = next((str(candidate / qtLeaf) for candidate in qtCandidates if (candidate / qtLeaf).is_dir()), None)
 
-if not os.path.exists(qtPath) and not args.no_qt:
-    logErrorAndExit ("QT Path does not exist - " + qtPath)
+# Qt isn't used by headless builds, so it only needs to be found when building with Qt
+if qtPath is None and not args.no_qt:
+    logErrorAndExit("Unable to find Qt root dir. Use --qt-root to specify\n    Locations checked:" + "".join("\n      " + str(candidate / qtLeaf) for candidate in qtCandidates))
 
 # Specify the type of Build files to generate
 qtGenerator = None
@@ -205,13 +326,68 @@ if sys.platform == "win32":
         if not support32BitBuild or args.platform != "x86":
             qtGenerator = qtGenerator + " Win64"
 
-elif sys.platform == "darwin":
-    if args.xcode:
+else:
+    # cmake refuses to change the generator of an existing build tree, so keep using the one the build files were
+    # already generated with
+    existingGenerator = None
+    for config in configs:
+        cmakeCachePath = os.path.join(cmakeOutputDir, config + internalSuffix, "CMakeCache.txt")
+        if os.path.isfile(cmakeCachePath):
+            with open(cmakeCachePath, errors="replace") as f:
+                existingGenerator = next((line.split("=", 1)[1].strip() for line in f if line.startswith("CMAKE_GENERATOR:INTERNAL=")), None)
+            if existingGenerator is not None:
+                break
+
+    # For new build trees prefer Ninja when it is installed as it has much lower overhead than make, especially for
+    # incremental builds
+    if sys.platform == "darwin" and args.xcode:
         qtGenerator="Xcode"
+    elif existingGenerator in ["Ninja", "Unix Makefiles"]:
+        qtGenerator=existingGenerator
+    elif shutil.which("ninja"):
+        qtGenerator="Ninja"
     else:
         qtGenerator="Unix Makefiles"
+
+# Locate cmake once, rather than searching the PATH for every configuration. The absolute path is used when running
+# cmake so the PATH doesn't need to be searched again each time it is started
+cmakePath = shutil.which("cmake")
+if cmakePath is None:
+    logErrorAndExit("cmake not found")
+
+# Path to the top level CMakeLists.txt
+cmakelistPath = os.path.normpath(os.path.join(scriptRoot, ".."))
+
+# Build the cmake arguments that are the same for every configuration
+releaseOutputDir = os.path.join(args.output, "release" + internalSuffix)
+debugOutputDir = os.path.join(args.output, "debug" + internalSuffix)
+
+if args.no_qt:
+    baseCmakeArgs = [cmakePath, cmakelistPath, "-DHEADLESS=TRUE"]
 else:
-    qtGenerator="Unix Makefiles"
+    baseCmakeArgs = [cmakePath, cmakelistPath, "-DCMAKE_PREFIX_PATH=" + qtPath, "-G", qtGenerator]
+
+if sys.platform == "win32":
+    if args.vs == "2019":
+        if not support32BitBuild or args.platform != "x86":
+            baseCmakeArgs.extend(["-A" + "x64"])
+
+        if args.toolchain == "2017":
+            baseCmakeArgs.extend(["-Tv141"])
+
+if args.internal:
+    baseCmakeArgs.extend(["-DINTERNAL_BUILD:BOOL=TRUE"])
+
+if args.disable_break:
+    baseCmakeArgs.extend(["-DDISABLE_RGP_DEBUG_BREAK:BOOL=TRUE"])
+
+baseCmakeArgs.extend(["-DCMAKE_RUNTIME_OUTPUT_DIRECTORY_RELEASE=" + releaseOutputDir])
+baseCmakeArgs.extend(["-DCMAKE_LIBRARY_OUTPUT_DIRECTORY_RELEASE=" + releaseOutputDir])
+baseCmakeArgs.extend(["-DCMAKE_RUNTIME_OUTPUT_DIRECTORY_DEBUG=" + debugOutputDir])
+baseCmakeArgs.extend(["-DCMAKE_LIBRARY_OUTPUT_DIRECTORY_DEBUG=" + debugOutputDir])
+
+if sys.platform == "darwin":
+    baseCmakeArgs.extend(["-DNO_APP_BUNDLE=" + str(args.no_bundle)])
 
 # Common code related to generating a build configuration
 def generateConfig(config):
@@ -221,34 +397,8 @@ def generateConfig(config):
     else:
         cmakeDir = cmakeOutputDir
 
-    cmakelistPath = os.path.join(scriptRoot, os.path.normpath(".."))
-
-    releaseOutputDir = os.path.join(args.output, "release" + internalSuffix)
-    debugOutputDir = os.path.join(args.output, "debug" + internalSuffix)
-
-    if args.no_qt:
-        cmakeArgs = ["cmake", cmakelistPath, "-DHEADLESS=TRUE"]
-    else:
-        cmakeArgs = ["cmake", cmakelistPath, "-DCMAKE_PREFIX_PATH=" + qtPath, "-G", qtGenerator]
-
-    if sys.platform == "win32":
-        if args.vs == "2019":
-            if not support32BitBuild or args.platform != "x86":
-                cmakeArgs.extend(["-A" + "x64"])
-
-            if args.toolchain == "2017":
-                cmakeArgs.extend(["-Tv141"])
-
-    if args.internal:
-        cmakeArgs.extend(["-DINTERNAL_BUILD:BOOL=TRUE"])
-
-    if args.disable_break:
-        cmakeArgs.extend(["-DDISABLE_RGP_DEBUG_BREAK:BOOL=TRUE"])
-
-    cmakeArgs.extend(["-DCMAKE_RUNTIME_OUTPUT_DIRECTORY_RELEASE=" + releaseOutputDir])
-    cmakeArgs.extend(["-DCMAKE_LIBRARY_OUTPUT_DIRECTORY_RELEASE=" + releaseOutputDir])
-    cmakeArgs.extend(["-DCMAKE_RUNTIME_OUTPUT_DIRECTORY_DEBUG=" + debugOutputDir])
-    cmakeArgs.extend(["-DCMAKE_LIBRARY_OUTPUT_DIRECTORY_DEBUG=" + debugOutputDir])
+    # Start from the arguments shared by every configuration
+    cmakeArgs = list(baseCmakeArgs)
 
     if sys.platform != "win32":
         if "RELEASE" in config.upper():
@@ -258,85 +408,117 @@ def generateConfig(config):
         else:
             logErrorAndExit("unknown configuration: " + config)
 
-    if sys.platform == "darwin":
-            cmakeArgs.extend(["-DNO_APP_BUNDLE=" + str(args.no_bundle)])
+    # Skip running cmake if the build files were already generated by this script with the same arguments. If a
+    # CMakeLists.txt file has changed since, the generated build files re-run cmake themselves when building
+    fingerprintFile = os.path.join(cmakeDir, ".prebuild_fingerprint")
+    fingerprint = hashlib.blake2b("\0".join(cmakeArgs).encode(), digest_size=16).hexdigest()
+    if not args.update and os.path.isfile(os.path.join(cmakeDir, "CMakeCache.txt")) and os.path.isfile(fingerprintFile):
+        with open(fingerprintFile) as f:
+            if f.read().strip() == fingerprint:
+                logPrint("CMake cache in " + cmakeDir + " up to date; skipping configure")
+                return None
 
-    if not distutils.spawn.find_executable(cmakeArgs[0]):
-        logErrorAndExit("cmake not found")
+    # the fingerprint is only rewritten once cmake succeeds
+    if os.path.isfile(fingerprintFile):
+        os.remove(fingerprintFile)
 
-    p = subprocess.Popen(cmakeArgs, cwd=cmakeDir, stderr=subprocess.STDOUT)
-    p.wait()
-    sys.stdout.flush()
-    if(p.returncode != 0):
-        logErrorAndExit("cmake failed with %d" % p.returncode)
+    # Start cmake without waiting for it to complete, buffering its output so it can be printed in one block
+    p = subprocess.Popen(cmakeArgs, cwd=cmakeDir, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return (p, fingerprintFile, fingerprint)
 
 logPrint("\nGenerating build files ...\n")
 if sys.platform == "win32":
     # On Windows always generates both Debug and Release configurations in a single solution file
-    generateConfig("")
+    generateConfigs = [""]
 else:
-    # For Linux & Mac - generate both Release and Debug configurations
-    for config in configs:
-        generateConfig(config)
+    # For Linux & Mac - generate both Release and Debug configurations. They are generated into separate
+    # directories so both cmake processes can run at the same time
+    generateConfigs = configs
+
+cmakeRuns = {}
+for config in generateConfigs:
+    cmakeRun = generateConfig(config)
+    if cmakeRun is not None:
+        cmakeRuns[config] = cmakeRun
+reapProcesses({"cmake for " + (config or "solution") + " configuration": p for config, (p, fingerprintFile, fingerprint) in cmakeRuns.items()})
+
+# Only check the results once every cmake process has finished, so all failing configurations are reported
+failedConfigs = [(config, p.returncode) for config, (p, fingerprintFile, fingerprint) in cmakeRuns.items() if p.returncode != 0]
+if failedConfigs:
+    logErrorAndExit("cmake failed for " + ", ".join("%s configuration with %d" % (config or "solution", returnCode) for config, returnCode in failedConfigs))
+
+# Record the arguments used to generate each configuration, writing to a temporary file first so that an interrupted
+# write can't leave a partial fingerprint behind
+for p, fingerprintFile, fingerprint in cmakeRuns.values():
+    with open(fingerprintFile + ".tmp", "w") as f:
+        f.write(fingerprint)
+    os.replace(fingerprintFile + ".tmp", fingerprintFile)
 
 # Optionally, the user can choose to build all configurations on conclusion of the prebuild job
 if (args.build):
-    for config in configs:
-        logPrint( "\nBuilding " + config + " configuration\n")
-        if sys.platform == "win32":
-            # Define the path to the Visual Studio directory that contains the VsDevCmd.bat file
-            vsDevPath = os.path.normpath ("C:/Program Files (x86)/Microsoft Visual Studio/2017/Professional/Common7/Tools/")
-            vsDevCommand = "VsDevCmd.bat"
-            msBuildCommand = "msbuild /nodeReuse:false /m:" + args.build_jobs + " /t:Build /p:Configuration=" + config + " /verbosity:minimal "
+    if sys.platform == "win32":
+        # Define the path to the Visual Studio directory that contains the VsDevCmd.bat file
+        vsDevPath = os.path.normpath ("C:/Program Files (x86)/Microsoft Visual Studio/2017/Professional/Common7/Tools/")
+        vsDevCommand = "VsDevCmd.bat"
 
-            # search in cmakeOutputDir for a Visual Studio solution file - we assume there is only 1 solution file in this directory
+        # Run VsDevCmd.bat once and capture the environment it sets up, so it doesn't need to be re-run for every build
+        try:
+            vsDevOutput = subprocess.check_output('"' + os.path.join(vsDevPath, vsDevCommand) + '" && set', shell=True, universal_newlines=True)
+        except subprocess.CalledProcessError as e:
+            logErrorAndExit("Failed to set up the Visual Studio environment using " + vsDevCommand + ": " + str(e))
+        buildEnvironment = dict(line.split("=", 1) for line in vsDevOutput.splitlines() if "=" in line)
 
-            solutionFile = None
-            for file in os.listdir(cmakeOutputDir):
-                if file.endswith('.sln'):
-                    solutionFile = file
+        # msbuild is only on the PATH of the captured environment, so look it up there
+        buildPath = next((value for key, value in buildEnvironment.items() if key.upper() == "PATH"), None)
+        msBuildPath = shutil.which("msbuild", path=buildPath)
+        if msBuildPath is None:
+            logErrorAndExit("msbuild not found")
 
-            if solutionFile == None:
-                logErrorAndExit("Unable to find solution file in location: " + cmakeOutputDir)
+        # search in cmakeOutputDir for a Visual Studio solution file - we assume there is only 1 solution file in this directory
+        solution = next(iter(glob.glob(os.path.join(glob.escape(cmakeOutputDir), "*.sln"))), None)
+        if solution is None:
+            logErrorAndExit("Unable to find solution file in location: " + cmakeOutputDir)
 
-            # Specify the solution to be used for the Windows build
-            solution = os.path.normpath(os.path.join(cmakeOutputDir, solutionFile))
+        # Specify the solution to be used for the Windows build
+        solution = os.path.normpath(solution)
 
-            # Build it
-            # All 3 of these commands need to be called like this to ensure the environment propagates through to the final call to msbuild
-            if os.system("c:" + " & cd " + vsDevPath + " & " + vsDevCommand + " & " + msBuildCommand + solution) != 0:
+    if sys.platform == "win32":
+        msBuildJobsArg = "/m:" + str(args.build_jobs)
+        for config in configs:
+            logPrint( "\nBuilding " + config + " configuration\n")
+
+            # node reuse keeps the msbuild worker processes running between the builds of each configuration
+            msBuildArgs = [msBuildPath, "/nodeReuse:true", msBuildJobsArg, "/t:Build", "/p:Configuration=" + config, "/verbosity:minimal"]
+
+            # Build it. The Documentation project is part of ALL_BUILD, so it is built alongside the code
+            if runCommand(msBuildArgs + [solution], env=buildEnvironment) != 0:
                 logErrorAndExit(config + " build failed for " + solution)
 
-            # Build the documentation
-            documentationProject = os.path.join(cmakeOutputDir, "Documentation.vcxproj")
-            if os.system("c:" + "& cd " + vsDevPath + " & " + vsDevCommand + " & " + msBuildCommand + documentationProject) != 0:
-                logErrorAndExit(config + " build failed for " + documentationProject)
+    else:
+        # linux & mac use the same commands. Each configuration has its own build directory, so all of them are
+        # built at the same time with the build jobs split between them
+        perConfigJobs = max(1, args.build_jobs // len(configs))
+        buildToolArgs = ["--", "-j" + str(perConfigJobs)]
 
-        else:
-            # linux & mac use the same commands
+        builds = {}
+        for config in configs:
+            logPrint("\nBuilding " + config + " configuration\n")
 
-            # generate the path to the config specific makefile
+            # generate the path to the config specific build files
             makeDir = os.path.join(cmakeOutputDir, config + internalSuffix)
 
-            makeArgs = ["make", "-j" + args.build_jobs, "-C", makeDir]
-
-            # Build it
-            logPrint ("Building configuration: " + config)
-            p = subprocess.Popen(makeArgs, stderr=subprocess.STDOUT)
-            p.wait()
-            sys.stdout.flush()
-            if(p.returncode != 0):
-                logErrorAndExit("make failed with %d" % p.returncode)
-
-            makeArgs.extend(["Documentation"])
-
-            # Build the documentation
-            logPrint ("Building documentation for configuration: " + config)
-            p = subprocess.Popen(makeArgs, stderr=subprocess.STDOUT)
-            p.wait()
-            sys.stdout.flush()
-            if(p.returncode != 0):
-                logErrorAndExit("make Documentation failed with %d" % p.returncode)
+            # let cmake invoke whichever build tool the files were generated for (make or ninja)
+            makeArgs = [cmakePath, "--build", makeDir]
+
+            # Build it. The Documentation target is part of the default target, so the build tool runs it in parallel
+            # with the code build. The output is buffered and printed once each build has finished
+            builds[config] = subprocess.Popen(makeArgs + buildToolArgs, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        reapProcesses({config + " build": p for config, p in builds.items()})
+
+        # Only check the results once every build has finished, so all failing configurations are reported
+        failedConfigs = [(config, p.returncode) for config, p in builds.items() if p.returncode != 0]
+        if failedConfigs:
+            logErrorAndExit("build failed for " + ", ".join("%s configuration with %d" % (config, returnCode) for config, returnCode in failedConfigs))
 
 
 minutes, seconds = divmod(time.time() - startTime, 60)